@@ -67,12 +67,13 @@ setup(
         'reddit', 'inverted index', 'search'
     ],
     install_requires = [
-        'spacy', 'pandas',
+        # spacy-lookups-data provides the lookup tables the blank
+        # pipeline's lemmatizer needs when --lemma is used
+        'spacy', 'spacy-lookups-data', 'pandas', 'numpy', 'requests',
     ],
     extras_require={
-        # eg:
-        #   'rst': ['docutils>=0.11'],
-        #   ':python_version=="2.6"': ['argparse'],
+        # optional accelerators, plain fallbacks are used when missing
+        'speed': ['indexed_bzip2', 'orjson'],
     },
     entry_points={
         'console_scripts': [
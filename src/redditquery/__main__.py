@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 import os
 import sys
-import pickle
 from redditquery.database import DataBase
 from redditquery.parse import parser
 from redditquery.index import InvertedIndex, QueryProcessor
@@ -19,37 +18,33 @@ def main():
         if not args.start or not args.end:
             raise ValueError("first and last month must be specified when building index.")
 
-        # download data and decompress
-        downloader = RedditDownloader(start = args.start, end = args.end, directory = os.path.join(args.dir, "monthly_data"), report_progress = args.progress, keep_compressed = False)
-        downloader.process_all_parallel(num_cores = args.cores)
+        # download data and decompress, streaming each month into the
+        # indexer as soon as it is ready so downloading, decompression
+        # and indexing overlap
+        downloader = RedditDownloader(start = args.start, end = args.end, directory = os.path.join(args.dir, "monthly_data"), report_progress = args.progress, keep_compressed = False, num_cores = args.cores)
 
         # make document generator
-        documents = DocumentGenerator(directory = os.path.join(args.dir, "monthly_data"), fulltext = args.fulltext, lemmatize = args.lemma)
+        documents = DocumentGenerator(directory = os.path.join(args.dir, "monthly_data"), fulltext = args.fulltext, lemmatize = args.lemma, num_cores = args.cores, paths = downloader.stream_paths(num_cores = args.cores), remove_after = True)
 
-        # make inverted index
-        database = DataBase(database_file = os.path.join(args.dir,"database.sql"))
+        # make inverted index, building in memory and
+        # writing the finished database out in one pass
+        database = DataBase(database_file = os.path.join(args.dir,"database.sql"), in_memory = True)
         inverted_index = InvertedIndex(documents = documents, database = database, frequency_threshold = args.minfreq)
+        database.dump_to()
 
-        # pickle inverted index for later use
-        # temporarily remove database connection
-        # (cannot be pickled)
-        with open(os.path.join(args.dir,"inverted_index.pickle"), "wb") as pickled:
-            db_tmp = inverted_index.database
-            inverted_index.database = 0
-            pickle.dump(inverted_index, pickled)
-            inverted_index.database = db_tmp
+        # save inverted index state for later use
+        inverted_index.save(args.dir)
 
 
     if args.mode == 2:
-        # load inverted index and add database connection back in
-        with open(os.path.join(args.dir,"inverted_index.pickle"), "rb") as pickled:
-            inverted_index = pickle.load(pickled)
-            inverted_index.database = DataBase(database_file = os.path.join(args.dir,"database.sql"), existing = True)
+        # load inverted index against the existing database
+        database = DataBase(database_file = os.path.join(args.dir,"database.sql"), existing = True)
+        inverted_index = InvertedIndex.load(args.dir, database)
 
 
     if args.mode in (2,3):
         # set-up query processor
-        processor = QueryProcessor(inverted_index = inverted_index, lemmatize = args.lemma, cores = args.cores)
+        processor = QueryProcessor(inverted_index = inverted_index, lemmatize = args.lemma)
 
         # process queries
         for query in sys.stdin:
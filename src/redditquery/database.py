@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 import os
 import sqlite3
-from itertools import repeat
 
 class DataBase:
     """Relationalizes a sparse term-document matrix
@@ -12,28 +11,70 @@ class DataBase:
                     File to use to store database in
     existing :      Boolean, optional
                     Connect to existing database instead of creating one
+    pragmas :       dict, optional
+                    Pragma settings overriding the defaults
+    in_memory :     Boolean, optional
+                    Build the database in memory; use dump_to to
+                    write it out once building is finished
     """
 
+    # WAL avoids an fsync per commit, mmap and a larger page cache
+    # keep the hot b-tree pages resident
+    DEFAULT_PRAGMAS = {"page_size": 4096,
+                       "journal_mode": "WAL",
+                       "synchronous": "NORMAL",
+                       "temp_store": "MEMORY",
+                       "mmap_size": 268435456,
+                       "cache_size": -65536,
+                       "secure_delete": "FALSE"}
 
-    def __init__(self, database_file, existing = False):
+
+    def __init__(self, database_file, existing = False, pragmas = None, in_memory = False):
         db_exists = os.path.isfile(database_file)
         if db_exists and not existing:
             raise FileExistsError("Database file already exists!")
-        self.connection = sqlite3.connect(database = database_file, isolation_level = None)
+        self.database_file = database_file
+        if in_memory:
+            target = ":memory:"
+        elif existing:
+            # open the finished database read-only, so queries skip all
+            # write-locking bookkeeping; temp tables stay writable
+            target = "file:{}?mode=ro".format(database_file)
+        else:
+            target = database_file
+        self.connection = sqlite3.connect(database = target, uri = existing and not in_memory, isolation_level = None)
         self.cursor = self.connection.cursor()
-        self.cursor.execute("PRAGMA journal_mode=OFF")
-        self.cursor.execute("PRAGMA synchronous=OFF")
-        self.cursor.execute("PRAGMA secure_delete=FALSE")
-        self.cursor.execute("PRAGMA page_size=4096")
+        settings = dict(self.DEFAULT_PRAGMAS)
+        if pragmas:
+            settings.update(pragmas)
+        if existing:
+            # changing the journal mode rewrites the database header,
+            # which a read-only connection cannot do
+            settings.pop("journal_mode", None)
+        # page_size must be set before the first schema write
+        self.cursor.execute("PRAGMA page_size={}".format(settings.pop("page_size")))
+        for pragma, value in settings.items():
+            self.cursor.execute("PRAGMA {}={}".format(pragma, value))
         if not existing:
             self.cursor.execute(
                 '''
                 CREATE TABLE doc_term_table(
-                document_id INTEGER,
-                term_id INTEGER,
-                score REAL,
-                PRIMARY KEY (document_id, term_id)
-                )
+                term_id INTEGER NOT NULL,
+                document_id INTEGER NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (term_id, document_id)
+                ) WITHOUT ROWID, STRICT
+                ''')
+            # raw counts are appended here during the build and only
+            # promoted into doc_term_table once the frequency threshold
+            # is known, so rare-term postings are never materialized
+            self.cursor.execute(
+                '''
+                CREATE TABLE staging(
+                document_id INTEGER NOT NULL,
+                term_id INTEGER NOT NULL,
+                score INTEGER NOT NULL
+                ) STRICT
                 ''')
             self.cursor.execute(
                 '''
@@ -43,34 +84,25 @@ class DataBase:
                 fulltext NVARCHAR
                 )
                 ''')
-            # auto-delete documents that cannot be queried after term deletion
-            self.cursor.execute(
-                '''
-                CREATE TRIGGER auto_delete AFTER DELETE ON doc_term_table 
-                BEGIN
-                DELETE FROM document_table
-                WHERE document_table.document_id = old.document_id
-                AND NOT EXISTS
-                (SELECT 1 FROM doc_term_table AS s
-                WHERE s.document_id = old.document_id);
-                END;
-                ''')
             self.connection.commit()
         else:
             assert(self.table_exists("doc_term_table"))
             assert(self.table_exists("document_table"))
+            # the query phase only ever reads, so map the whole file
+            # (mmap_size is a hint, pages are mapped as touched) and
+            # keep a larger page cache than during the build
+            self.cursor.execute("PRAGMA mmap_size=30000000000")
+            self.cursor.execute("PRAGMA cache_size=-262144")
 
 
-    def insert_document(self, document_id, document_name, term_scores, fulltext):
-        """Insert document into database table(s).
+    def insert_document(self, document_id, document_name, fulltext):
+        """Insert document into document table.
         Parameters
         ----------
         document_id :   int
                         id of the document
         document_name : str
                         Name of the document
-        term_scores :   iterable of tuples of int, float
-                        Term ids and term scores
         fulltext :      str
                         string of document's text
         """
@@ -79,26 +111,99 @@ class DataBase:
             INSERT INTO document_table
             VALUES(?,?,?)
             ''',(document_id, document_name, fulltext))
+
+
+    def insert_documents_bulk(self, document_rows, term_rows):
+        """Insert many documents into database table(s) at once,
+        using constant parameterized statements so SQLite's statement
+        cache hits on every call.
+        Parameters
+        ----------
+        document_rows : iterable of tuples of int, str, str
+                        Document ids, names and fulltexts
+        term_rows :     iterable of tuples of int, int, float
+                        Document ids, term ids and term scores,
+                        consumed once
+        """
         self.cursor.executemany(
             '''
-            INSERT INTO doc_term_table
-            VALUES({},?,?)
-            '''.format(document_id),list(term_scores))
+            INSERT INTO document_table
+            VALUES(?,?,?)
+            ''', document_rows)
+        self.cursor.executemany(
+            '''
+            INSERT INTO staging
+            VALUES(?,?,?)
+            ''', term_rows)
 
 
     def retrieve_term(self, term_id):
-        """Retrieve postings list for term
+        """Retrieve postings list for term from index table.
         Parameters
         ----------
         term_id :   int
                     id of term whose postings list is to be retrieved
         """
-        document_ids = self.cursor.execute(
+        rows = self.cursor.execute(
             '''
             SELECT document_id FROM doc_term_table
             WHERE term_id == ?
             ''',(term_id,)).fetchall()
-        return [document_id[0] for document_id in document_ids]
+        if not rows:
+            return []
+        document_ids, = zip(*rows)
+        return list(document_ids)
+
+
+    def promote_staging(self, frequency_threshold):
+        """Move staged counts whose terms pass the frequency threshold
+        into the index table and drop the staging table, so infrequent
+        postings are filtered out instead of inserted and deleted.
+        Documents left without any queryable term are removed as well.
+        Parameters
+        ----------
+        frequency_threshold :   int
+                                total frequency above which terms are kept
+        """
+        self.cursor.execute("CREATE INDEX staging_term_index ON staging (term_id)")
+        self.cursor.execute(
+            '''
+            INSERT INTO doc_term_table
+            SELECT term_id, document_id, score FROM staging
+            WHERE term_id IN
+            (SELECT term_id FROM staging
+            GROUP BY term_id
+            HAVING SUM(score) > ?)
+            ORDER BY term_id, document_id
+            ''',(frequency_threshold,))
+        self.cursor.execute("DROP TABLE staging")
+        self.cursor.execute(
+            '''
+            DELETE FROM document_table
+            WHERE document_id NOT IN
+            (SELECT document_id FROM doc_term_table)
+            ''')
+        self.connection.commit()
+
+
+    def retrieve_terms_union(self, term_ids):
+        """Retrieve ids of all documents containing any of the terms,
+        letting SQLite compute the union in one query.
+        Parameters
+        ----------
+        term_ids :  list of int
+                    ids of terms whose postings are to be merged
+        """
+        placeholders = ",".join("?" * len(term_ids))
+        rows = self.cursor.execute(
+            '''
+            SELECT DISTINCT document_id FROM doc_term_table
+            WHERE term_id IN ({})
+            '''.format(placeholders), term_ids).fetchall()
+        if not rows:
+            return []
+        document_ids, = zip(*rows)
+        return list(document_ids)
 
 
     def retrieve_document(self, document_id):
@@ -116,26 +221,63 @@ class DataBase:
         return terms_scores
 
 
-    def get_document_retriever(self):
-        """Return a function that retrieves documents by id, using its own
-        connection (for parallel access).
+    def score_query(self, query_weights, num_results, conjunctive = False):
+        """Score documents against a query vector and return the best.
+        The query weights are staged in a temporary table and the dot
+        product, the optional all-terms filter and the top-k selection
+        all run inside SQLite.
+        Parameters
+        ----------
+        query_weights : iterable of tuples of int, float
+                        term ids and weights of the query vector
+        num_results :   int
+                        number of most similar documents to return
+        conjunctive :   Boolean, optional
+                        only return documents containing all query terms
         """
-        db_path = self.cursor.execute("PRAGMA database_list").fetchall()[0][2]
-        cursor = sqlite3.connect(db_path, isolation_level = None).cursor()
-        def retrieve_document(document_id):
-            """Retrieve terms and scores for a document from index table.
-            Parameters
-            ----------
-            document_id :   int
-                            id of document to be retrieved
-            """
-            term_scores = cursor.execute(
-                '''
-                SELECT term_id, score FROM doc_term_table
-                WHERE document_id == ?
-                ''',(document_id,)).fetchall()
-            return term_scores
-        return retrieve_document
+        self.cursor.execute(
+            '''
+            CREATE TEMP TABLE IF NOT EXISTS query_vector(
+            term_id INTEGER PRIMARY KEY,
+            weight REAL
+            )
+            ''')
+        self.cursor.execute("DELETE FROM query_vector")
+        self.cursor.executemany(
+            '''
+            INSERT INTO query_vector
+            VALUES(?,?)
+            ''', query_weights)
+        having = "HAVING COUNT(*) = (SELECT COUNT(*) FROM query_vector)" if conjunctive else ""
+        return self.cursor.execute(
+            '''
+            SELECT d.document_id, SUM(d.score * q.weight) AS similarity
+            FROM doc_term_table AS d JOIN query_vector AS q
+            ON d.term_id = q.term_id
+            GROUP BY d.document_id {}
+            ORDER BY similarity DESC
+            LIMIT ?
+            '''.format(having), (num_results,)).fetchall()
+
+
+    def retrieve_postings_by_term(self):
+        """Retrieve all (term_id, document_id, score) rows ordered by
+        term, served sequentially from the unique term/document index."""
+        return self.cursor.execute(
+            '''
+            SELECT term_id, document_id, score FROM doc_term_table
+            ORDER BY term_id, document_id
+            ''').fetchall()
+
+
+    def retrieve_all_postings(self):
+        """Retrieve all (document_id, term_id, score) rows from the
+        index table in one sequential scan, ordered by document."""
+        return self.cursor.execute(
+            '''
+            SELECT document_id, term_id, score FROM doc_term_table
+            ORDER BY document_id
+            ''').fetchall()
 
 
     def get_fulltext(self, document_id):
@@ -154,33 +296,100 @@ class DataBase:
 
 
     def remove_terms(self, term_ids):
-        """Remove list of terms from index table
+        """Remove terms from index table,
+        staged through a temporary table so all postings are removed
+        in a single DELETE statement.
         Parameters
         ----------
-        term_ids :  iterable of singleton tuples of int
-                    term ids to be removed
+        term_ids :  iterable of int
+                    term ids to be removed, consumed once
         """
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS removed_terms(term_id INTEGER PRIMARY KEY)")
+        self.cursor.execute("DELETE FROM removed_terms")
         self.cursor.executemany(
+            '''
+            INSERT OR IGNORE INTO removed_terms
+            VALUES(?)
+            ''', ((term_id,) for term_id in term_ids))
+        self.cursor.execute(
             '''
             DELETE FROM doc_term_table
-            WHERE term_id == ?
-            ''', term_ids)
+            WHERE term_id IN (SELECT term_id FROM removed_terms)
+            ''')
+        # clean up documents that cannot be queried any more
+        # in one sweep rather than per deleted row
+        self.cursor.execute(
+            '''
+            DELETE FROM document_table
+            WHERE document_id NOT IN
+            (SELECT document_id FROM doc_term_table)
+            ''')
+        self.connection.commit()
+
+
+    def rebuild_scores(self, score_tuples):
+        """Replace the index table with freshly scored rows.
+        Sequential inserts into a new unindexed table are much faster
+        than random in-place updates through the covering index; the
+        indexes are rebuilt once in prepare_searches.
+        Parameters
+        ----------
+        score_tuples :  iterable of tuples of float, int, int
+                        scores, document ids and term ids, consumed once
+        """
+        self.cursor.execute(
+            '''
+            CREATE TABLE doc_term_table_new(
+            term_id INTEGER NOT NULL,
+            document_id INTEGER NOT NULL,
+            score INTEGER NOT NULL
+            ) STRICT
+            ''')
+        self.cursor.executemany(
+            '''
+            INSERT INTO doc_term_table_new(score, document_id, term_id)
+            VALUES(?,?,?)
+            ''', score_tuples)
+        self.cursor.execute("DROP TABLE doc_term_table")
+        self.cursor.execute("ALTER TABLE doc_term_table_new RENAME TO doc_term_table")
         self.connection.commit()
 
 
     def update_documents(self, score_tuples):
-        """Change term scores of a given document
+        """Change term scores of a given document,
+        staged through a temporary table so the scores are applied
+        in a single UPDATE statement.
         Parameters
         ----------
         score_tuples :  iterable of tuples of float, int, int
                         scores for document ids and term ids to be updated
         """
+        self.cursor.execute(
+            '''
+            CREATE TEMP TABLE IF NOT EXISTS score_updates(
+            score INTEGER,
+            document_id INTEGER,
+            term_id INTEGER,
+            PRIMARY KEY (document_id, term_id)
+            )
+            ''')
+        self.cursor.execute("DELETE FROM score_updates")
         self.cursor.executemany(
             '''
-            UPDATE doc_term_table SET score = ?
-            WHERE document_id == ?
-            AND term_id == ?
+            INSERT INTO score_updates
+            VALUES(?,?,?)
             ''', score_tuples)
+        self.cursor.execute(
+            '''
+            UPDATE doc_term_table SET score =
+            (SELECT score FROM score_updates AS u
+            WHERE u.document_id = doc_term_table.document_id
+            AND u.term_id = doc_term_table.term_id)
+            WHERE EXISTS
+            (SELECT 1 FROM score_updates AS u
+            WHERE u.document_id = doc_term_table.document_id
+            AND u.term_id = doc_term_table.term_id)
+            ''')
         self.connection.commit()
 
 
@@ -191,12 +400,34 @@ class DataBase:
         term_id :   int
                     id of term to get number of containing documents for
         """
-        documents = self.cursor.execute(
+        count = self.cursor.execute(
             '''
-            SELECT document_id FROM doc_term_table
+            SELECT COUNT(*) FROM doc_term_table
             WHERE term_id == ?
-            ''',(term_id,)).fetchall()
-        return len(documents)
+            ''',(term_id,)).fetchone()
+        return count[0]
+
+
+    def get_term_ids(self):
+        """Get ids of all terms left in the index table."""
+        rows = self.cursor.execute(
+            '''
+            SELECT DISTINCT term_id FROM doc_term_table
+            ''').fetchall()
+        if not rows:
+            return []
+        term_ids, = zip(*rows)
+        return list(term_ids)
+
+
+    def get_document_frequencies(self):
+        """Get number of containing documents for every term id
+        in one aggregate query."""
+        return self.cursor.execute(
+            '''
+            SELECT term_id, COUNT(*) FROM doc_term_table
+            GROUP BY term_id
+            ''').fetchall()
 
 
     def get_document_name(self, document_id):
@@ -245,14 +476,38 @@ class DataBase:
         self.connection.commit()
 
 
+    def finalize_schema(self):
+        """Restore the unique (term_id, document_id) constraint that
+        rebuild_scores drops for its sequential bulk load, clustering
+        the scored rows for the term-major join in score_query."""
+        self.cursor.execute("""
+            CREATE UNIQUE INDEX term_document_index ON doc_term_table (term_id, document_id)
+            """)
+        self.connection.commit()
+
+
     def create_covering_index(self):
-        """Create composite index on document_id and term_id"""
+        """Create covering index on document_id, term_id and score,
+        so document lookups and score updates are served entirely
+        from the index leaves."""
         self.cursor.execute("""
-            CREATE INDEX covering_index ON doc_term_table (document_id, term_id)
+            CREATE INDEX covering_index ON doc_term_table (document_id, term_id, score)
             """)
         self.connection.commit()
 
 
+    def dump_to(self, path = None):
+        """Write the database to disk in one sequential pass.
+        Parameters
+        ----------
+        path :  str or path object, optional
+                File to write to, defaults to the database_file
+                the instance was created with
+        """
+        self.connection.commit()
+        self.cursor.execute("VACUUM INTO ?", (path or self.database_file,))
+
+
     def table_exists(self, table):
         """Check whether table exists.
         Parameters
@@ -271,15 +526,22 @@ class DataBase:
         self.cursor.execute("BEGIN")
 
     def prepare_deletes(self):
-        """commit inserts, create index on term_id for fast deletions"""
+        """commit inserts; the primary key already clusters on term_id,
+        so deletions need no extra index"""
         self.connection.commit()
-        self.create_index("term_id")
 
     def prepare_updates(self):
-        """create index on document id for fast updates"""
-        self.create_index("document_id")
+        """commit promotions; scores are rebuilt into a fresh table,
+        which needs no index"""
+        self.connection.commit()
 
     def prepare_searches(self):
-        """Vacuum."""
+        """Restore the unique term/document index, create the covering
+        index, refresh planner statistics and vacuum."""
+        self.finalize_schema()
+        self.create_covering_index()
+        # fresh statistics let the planner pick the new indexes for
+        # the scoring join
+        self.cursor.execute("ANALYZE")
         self.connection.execute('VACUUM')
         self.connection.commit()
\ No newline at end of file
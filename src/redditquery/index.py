@@ -1,12 +1,17 @@
 #!/usr/bin/python3
+import os
 import sys
-import spacy
-from math import log2
-from heapq import nlargest
-from functools import partial
-from collections import Counter
-from multiprocessing import Process, Queue
-from redditquery.utils import Numberer, l2_norm
+import json
+import numpy as np
+from redditquery.utils import Numberer
+from redditquery.reddit import make_nlp
+
+# normalized tf-idf scores are stored as fixed-point integers
+# (score * SCORE_SCALE) so each posting holds a small varint
+# instead of an 8-byte float; normalized weights lie in [0, 1], so
+# scaling by 2^16 - 1 uses the full u16 range, and ranking is
+# unchanged under the monotonic scaling
+SCORE_SCALE = 65535
 
 
 class InvertedIndex:
@@ -25,11 +30,68 @@ class InvertedIndex:
         self.num_documents = 0
         self.database = database
         self.vocabulary_indices = Numberer()
+        self.term_frequencies = np.zeros(1024, dtype = np.int64)
+        self.documents_buffer = list()
+        self.postings_buffer = list()
+        self.buffer_size = 30000
 
         self.make_indices(documents = documents)
         self.remove_infrequent(frequency_threshold)
         self.transform_to_tfidf()
         self.prepare_searches()
+        self.make_postings_cache()
+
+
+    def save(self, directory):
+        """Save the index state next to the database, using a numpy
+        sidecar for the dense idf array and json for the vocabulary,
+        which pickles poorly as a generic mapping.
+        Parameters
+        ----------
+        directory : str or path object
+                    Directory to save index state in
+        """
+        np.save(os.path.join(directory, "idf.npy"), self.idf_cache)
+        np.savez(os.path.join(directory, "postings.npz"),
+                 ptr = self.postings_ptr,
+                 documents = self.postings_doc,
+                 scores = self.postings_score)
+        with open(os.path.join(directory, "vocabulary.json"), "w", encoding = "utf-8") as vocabulary:
+            json.dump(self.vocabulary_indices.known, vocabulary)
+        with open(os.path.join(directory, "index.json"), "w") as meta:
+            json.dump({"num_documents": self.num_documents,
+                       "num_terms": self.vocabulary_indices.num_keys}, meta)
+
+
+    @classmethod
+    def load(cls, directory, database):
+        """Load an index saved with save.
+        Parameters
+        ----------
+        directory : str or path object
+                    Directory the index state was saved in
+        database :  database object
+                    Database to attach to the index
+        """
+        index = cls.__new__(cls)
+        index.database = database
+        index.documents_buffer = list()
+        index.postings_buffer = list()
+        index.buffer_size = 30000
+        with open(os.path.join(directory, "index.json"), "r") as meta:
+            meta = json.load(meta)
+        index.num_documents = meta["num_documents"]
+        index.vocabulary_indices = Numberer()
+        with open(os.path.join(directory, "vocabulary.json"), "r", encoding = "utf-8") as vocabulary:
+            index.vocabulary_indices.known = json.load(vocabulary)
+        index.vocabulary_indices.by_value = {number: term for term, number in index.vocabulary_indices.known.items()}
+        index.vocabulary_indices.num_keys = meta["num_terms"]
+        index.idf_cache = np.load(os.path.join(directory, "idf.npy"))
+        postings = np.load(os.path.join(directory, "postings.npz"))
+        index.postings_ptr = postings["ptr"]
+        index.postings_doc = postings["documents"]
+        index.postings_score = postings["scores"]
+        return index
 
 
     def make_indices(self, documents):
@@ -42,6 +104,7 @@ class InvertedIndex:
         self.prepare_inserts()
         for document in documents:
             self.process_document(document)
+        self.flush_postings()
 
 
     def process_document(self, document):
@@ -52,43 +115,136 @@ class InvertedIndex:
                         Document to be processed
         """
         document_name = document[0]
+        tokens = document[1]
         fulltext = document[2]
-        terms = [self.vocabulary_indices.get(term) for term in document[1]]
-        term_counts = Counter(terms)
-        self.insert_document(self.num_documents, document_name, term_counts.items(), fulltext)
+        # bind the method once, the loop runs once per token
+        get_term_id = self.vocabulary_indices.get
+        term_ids = np.fromiter(map(get_term_id, tokens), dtype = np.int64, count = len(tokens))
+        # counting happens in C on the id array instead of a Counter
+        term_ids, counts = np.unique(term_ids, return_counts = True)
+        while self.vocabulary_indices.num_keys > len(self.term_frequencies):
+            self.term_frequencies = np.concatenate(
+                (self.term_frequencies, np.zeros(len(self.term_frequencies), dtype = np.int64)))
+        np.add.at(self.term_frequencies, term_ids, counts)
+        document_id = self.num_documents
+        self.documents_buffer.append((document_id, document_name, fulltext))
+        self.postings_buffer.extend((document_id, term_id, count) for term_id, count in zip(term_ids.tolist(), counts.tolist()))
+        if len(self.postings_buffer) >= self.buffer_size:
+            self.flush_postings()
         self.num_documents += 1
 
 
+    def flush_postings(self):
+        """Write buffered document rows and (document_id, term_id,
+        score) triples to the database."""
+        if self.documents_buffer or self.postings_buffer:
+            self.database.insert_documents_bulk(self.documents_buffer, self.postings_buffer)
+            self.documents_buffer = list()
+            self.postings_buffer = list()
+
+
     def remove_infrequent(self, frequency_threshold):
-        """Remove infrequent terms from index.
+        """Keep only sufficiently frequent terms in the index.
+        The database filters staged postings by total frequency while
+        promoting them into the index table; the vocabulary is pruned
+        against the total frequencies accumulated during indexing, so
+        no read-back query is needed.
         Parameters
         ----------
         frequency_threshold :   int
                                 frequency below which terms will be removed
         """
-        infrequent = self.get_infrequent(frequency_threshold)
         self.prepare_deletes()
-        self.remove_terms(infrequent)
-        self.vocabulary_indices.remove_values([term[0] for term in infrequent])
+        self.promote_staging(frequency_threshold)
+        totals = self.term_frequencies[:self.vocabulary_indices.num_keys]
+        infrequent = np.where(totals <= frequency_threshold)[0].tolist()
+        self.vocabulary_indices.remove_values(infrequent)
 
 
     def transform_to_tfidf(self):
-        """Turn frequency counts in index into pmi values."""
+        """Turn frequency counts in index into normalized tf-idf
+        scores, computed over all postings at once with numpy."""
         self.prepare_updates()
-        updates = list()
-        for doc_id in range(self.num_documents):
-            frequencies = self.get_document(doc_id)
-            tfidfs = [(term_id, self.tfidf(term_id, frequency)) for term_id, frequency in frequencies]
-            norm = l2_norm([tfidf for _, tfidf in tfidfs])
-            normed = [(tfidf/norm, doc_id, term_id) for term_id, tfidf in tfidfs]
-            updates += normed
-            #update database every 10000 documents
-            if doc_id%10000 == 0:
-                self.update_documents(updates)
-                updates = list()
-        # update remaining documents
-        if updates:
-            self.update_documents(updates)
+        self.make_idf_cache()
+        rows = np.array(self.retrieve_all_postings(), dtype = np.int64)
+        if len(rows) == 0:
+            self.rebuild_scores([])
+            return
+        document_ids = rows[:, 0]
+        term_ids = rows[:, 1]
+        tfidfs = rows[:, 2] * self.idf_cache[term_ids]
+        # rows are sorted by document, so each document is one segment
+        _, starts, counts = np.unique(document_ids, return_index = True, return_counts = True)
+        norms = np.sqrt(np.add.reduceat(tfidfs * tfidfs, starts))
+        # a document whose surviving terms all have idf 0 (terms in
+        # every document) has norm 0; keep its scores at 0 instead of
+        # dividing them into NaN
+        norms[norms == 0] = 1
+        tfidfs /= np.repeat(norms, counts)
+        scores = np.rint(tfidfs * SCORE_SCALE).astype(np.int64)
+        self.rebuild_scores(zip(scores.tolist(), document_ids.tolist(), term_ids.tolist()))
+
+
+    def make_postings_cache(self):
+        """Cache the scored postings in a flat CSR layout: offsets per
+        term id into parallel document and score arrays, loaded from
+        the database in one term-ordered scan. The postings are
+        immutable once searching starts, so queries can be answered
+        from these arrays without touching the database."""
+        rows = np.array(self.retrieve_postings_by_term(), dtype = np.int64)
+        if len(rows) == 0:
+            rows = np.zeros((0, 3), dtype = np.int64)
+        num_terms = self.vocabulary_indices.num_keys
+        self.postings_ptr = np.searchsorted(rows[:, 0], np.arange(num_terms + 1))
+        self.postings_doc = np.ascontiguousarray(rows[:, 1])
+        self.postings_score = rows[:, 2].astype(np.float32)
+
+
+    def score_documents(self, query_weights, num_results, conjunctive):
+        """Score documents against a weighted query on the in-memory
+        postings cache: each query term contributes one array slice,
+        accumulated into a dense score vector, and the top results are
+        selected with a partial sort.
+        Parameters
+        ----------
+        query_weights : iterable of tuples of int, float
+                        ids and normalized tf-idfs of terms in the query
+        num_results :   int
+                        Number of most similar results to return
+        conjunctive :   Boolean
+                        Require documents to contain all query terms
+        """
+        query_weights = list(query_weights)
+        scores = np.zeros(self.num_documents)
+        matched = np.zeros(self.num_documents, dtype = np.int64) if conjunctive else None
+        for term_id, weight in query_weights:
+            start, end = self.postings_ptr[term_id], self.postings_ptr[term_id + 1]
+            documents = self.postings_doc[start:end]
+            # document ids are unique within one posting list, so the
+            # fancy-indexed addition never writes an index twice
+            scores[documents] += self.postings_score[start:end] * weight
+            if conjunctive:
+                matched[documents] += 1
+        if conjunctive:
+            scores[matched < len(query_weights)] = 0
+        num_results = min(num_results, len(scores))
+        if num_results == 0:
+            return []
+        top = np.argpartition(scores, -num_results)[-num_results:]
+        top = top[np.argsort(scores[top])[::-1]]
+        top = top[scores[top] > 0]
+        return list(zip(top.tolist(), scores[top].tolist()))
+
+
+    def make_idf_cache(self):
+        """Precompute idf values for all terms into an array indexed
+        by term id, fetching all document frequencies in one query."""
+        document_frequencies = np.ones(self.vocabulary_indices.num_keys, dtype = np.int64)
+        for term_id, document_frequency in self.get_document_frequencies():
+            document_frequencies[term_id] = document_frequency
+        self.idf_cache = np.log2(self.num_documents / document_frequencies)
+
+
 
 
     def tfidf(self, term_id, frequency):
@@ -103,25 +259,27 @@ class InvertedIndex:
 
 
     def get_idf(self, term_id):
-        """Calculate idf.
+        """Look up idf in the cache built after indexing; no query
+        recomputes the logarithm or counts documents in the database.
         Parameters
         ----------
         term_id :   int
                     id of term
         """
-        idf = log2(self.num_documents / max(self.get_document_frequency(term_id),1))
-        return idf
+        return self.idf_cache[term_id]
 
 
 
     def get_term_id(self, term):
-        """Return term_id for given term.
+        """Return term_id for given term, -1 if the term is not in
+        the vocabulary; looking up a query term must not grow the
+        vocabulary, so this never assigns new ids.
         Parameters
         ----------
         term :  str
                 term to get id for
         """
-        return self.vocabulary_indices.get(term)
+        return self.vocabulary_indices.lookup(term)
 
 
     # interfaces for database
@@ -134,6 +292,15 @@ class InvertedIndex:
         """
         return self.database.retrieve_term(term_id)
 
+    def get_candidates(self, term_ids):
+        """Retrieve ids of documents containing any of the terms.
+        Parameters
+        ----------
+        term_ids :  list of int
+                    ids of terms whose postings are to be merged
+        """
+        return self.database.retrieve_terms_union(term_ids)
+
     def get_document_name(self, doc_id):
         """get document name associated with doc id.
         Parameters
@@ -163,30 +330,38 @@ class InvertedIndex:
         """
         return self.database.retrieve_document(doc_id)
 
-    def insert_document(self, document_id, document_name, term_scores, fulltext):
-        """Insert document into database table(s).
+    def promote_staging(self, frequency_threshold):
+        """Promote staged postings that pass the frequency threshold
+        into the index table.
         Parameters
         ----------
-        document_id :   int
-                        id of the document
-        document_name : str
-                        Name of the document
-        term_scores :   iterable of tuples of int, float
-                        Term ids and term scores
-        fulltext :      str
-                        string of document's text
+        frequency_threshold :   int
+                                total frequency above which terms are kept
         """
-        self.database.insert_document(document_id, document_name, term_scores, fulltext)
+        self.database.promote_staging(frequency_threshold)
 
     def remove_terms(self, infrequent):
-        """Remove list of terms from database.
+        """Remove terms from database.
         Parameters
         ----------
-        term_ids :  iterable of singleton tuples of int
+        term_ids :  iterable of int
                     term ids to be removed
         """
         self.database.remove_terms(infrequent)
 
+    def retrieve_all_postings(self):
+        """Retrieve all postings from the database in one scan."""
+        return self.database.retrieve_all_postings()
+
+    def rebuild_scores(self, score_tuples):
+        """Replace the index table with freshly scored rows.
+        Parameters
+        ----------
+        score_tuples :  iterable of tuples of float, int, int
+                        scores, document ids and term ids
+        """
+        self.database.rebuild_scores(score_tuples)
+
     def update_documents(self, updates):
         """Change term scores of a given document.
         Parameters
@@ -205,6 +380,14 @@ class InvertedIndex:
         """
         return self.database.get_document_frequency(term_id)
 
+    def get_document_frequencies(self):
+        """Get number of containing documents for every term id."""
+        return self.database.get_document_frequencies()
+
+    def get_term_ids(self):
+        """Get ids of all terms left in the index table."""
+        return self.database.get_term_ids()
+
     def get_fulltext(self, doc_id):
         """Retrieve text of a document by its id.
         Parameters
@@ -214,11 +397,9 @@ class InvertedIndex:
         """
         return self.database.get_fulltext(doc_id)
 
-    def get_document_retriever(self):
-        """Return a function that retrieves documents by id, using its own
-        connection (for parallel access).
-        """
-        return self.database.get_document_retriever()
+    def retrieve_postings_by_term(self):
+        """Retrieve all postings from the database ordered by term."""
+        return self.database.retrieve_postings_by_term()
 
     def prepare_inserts(self):
         """Prepare database for insertions."""
@@ -245,15 +426,12 @@ class QueryProcessor():
                         Index to be queried
     lemmatize :         Boolean
                         Lemmatize queries
-    cores :             Int
-                        Number of cores to use
     """
 
-    def __init__(self, inverted_index, lemmatize, cores):
+    def __init__(self, inverted_index, lemmatize):
         self.inverted_index = inverted_index
-        self.nlp = spacy.load("en")
+        self.nlp = make_nlp(lemmatize)
         self.lemmatize = lemmatize
-        self.cores = cores
 
 
     def query_index(self, query, num_results, fulltext, conjunctive):
@@ -271,96 +449,56 @@ class QueryProcessor():
         """
         tokens = self.nlp(query)
         if self.lemmatize:
-            query = [token.lemma_.strip().lower() for token in tokens if not token.pos_.startswith(u"PU")] # filter punctuation
+            query = [token.lemma_.lower() for token in tokens if not token.is_punct]
         else:
-            query = [token.string.strip().lower() for token in tokens if not token.pos_.startswith(u"PU")]
+            query = [token.lower_ for token in tokens if not token.is_punct]
         # ignore multiple occurrences, keep as list to guarantee
         # query[i] belongs to term_ids[i]
         query = list(set(query))
-        term_ids = [self.get_term_id(term) for term in query]
-        # get all documents containing any of the query terms
-        candidates = set()
-        for term_id in term_ids:
-            doc_ids = self.get_postings_list(term_id)
-            if 'candidates' not in locals():
-                candidates = set(doc_ids)
-            elif conjunctive:
-                candidates.intersection_update(doc_ids)
-            else:
-                candidates.update(doc_ids)
-        # get similarity between documents and query
+        # unknown terms cannot match any document, drop them rather
+        # than sending non-existent ids into the database
+        known = [(term, self.get_term_id(term)) for term in query]
+        known = [(term, term_id) for term, term_id in known if term_id >= 0]
+        if not known:
+            sys.stdout.write("none of the query terms are in the index\n\n")
+            return
+        query, term_ids = zip(*known)
         query_tfidfs = self.query_to_tfidf(term_ids)
-        # hacked parallelization into here
-        if self.cores > 1:
-            candidates = list(candidates)
-            retrievers = [self.get_document_retriever() for _ in range(self.cores)]
-            results = Queue()
-            processes = list()
-            for i in range(self.cores):
-                kwargs = {"candidates":candidates[i::self.cores],
-                        "query_tfidfs":query_tfidfs,
-                        "queue":results,
-                        "retriever":retrievers[i]}
-                p = Process(target=self.get_similarity_parallel, kwargs = kwargs)
-                processes.append(p)
-            for process in processes:
-                process.start()
-            for process in processes:
-                process.join()
-            results.put("STOP")
-            similarities = iter(results.get, "STOP")
-        else:
-            get_similarity = partial(self.get_similarity, query_tfidfs = query_tfidfs)
-            similarities = map(get_similarity, candidates)
-        for i, term in enumerate(query):
-            term_idf = self.get_idf(term_ids[i])
-            sys.stdout.write("idf({0}): {1:2f}\n".format(term, term_idf))
-        for similarity, doc_id in nlargest(num_results, similarities):
+        # candidate selection and scoring run as a single aggregated
+        # join over the index table, ordered and limited in the database
+        results = self.score_documents(query_tfidfs, num_results, conjunctive)
+        # collect the report and write it out in one call
+        lines = list()
+        for term, term_id in zip(query, term_ids):
+            lines.append("idf({0}): {1:2f}".format(term, self.get_idf(term_id)))
+        for doc_id, similarity in results:
             doc_name = self.get_document_name(doc_id)
-            sys.stdout.write("{0} ({1:3f}): {2}\n".format(doc_id, similarity, doc_name))
+            lines.append("{0} ({1:3f}): {2}".format(doc_id, similarity / SCORE_SCALE, doc_name))
             if fulltext:
-                text = self.get_fulltext(doc_id)
-                sys.stdout.write(text.strip()+"\n\n")
-        sys.stdout.write("\n")
-
-
-    def get_similarity(self, candidate, query_tfidfs):
-        """Calculate cosine similarity between candidate and query.
-        Parameters
-        ----------
-        candidate :     int
-                        id of candidate document
-        query_tfidfs :  iterable of tuples of int, float
-                        ids and tfidfs of terms in the query
-        """
-        candidate_tfidfs = dict(self.get_document(candidate))
-        cosine = 0
-        for term_id, tf_idf in query_tfidfs:
-            if term_id in candidate_tfidfs:
-                cosine += tf_idf * candidate_tfidfs[term_id]
-        return cosine, candidate
-
-    def get_similarity_parallel(self, candidates, query_tfidfs, queue, retriever):
-        for candidate in candidates:
-            candidate_tfidfs = dict(retriever(candidate))
-            cosine = 0
-            for term_id, tf_idf in query_tfidfs:
-                if term_id in candidate_tfidfs:
-                    cosine += tf_idf * candidate_tfidfs[term_id]
-            queue.put((cosine, candidate))
+                lines.append(self.get_fulltext(doc_id).strip() + "\n")
+        lines.append("")
+        sys.stdout.write("\n".join(lines) + "\n")
 
 
     def query_to_tfidf(self, query):
-        """Turn query into vector of normed tf-ids scores
+        """Turn query into vector of normed tf-ids scores,
+        normalizing in one fused pass over a numpy array instead of
+        separate sum-of-squares and division passes
         Parameters
         ----------
         query : iterable of int
                 ids of terms in the query
         """
-        query_tfidfs = [(term_id, self.tfidf(term_id, 1)) for term_id in query]
-        norm = l2_norm([tfidf for _, tfidf in query_tfidfs])
-        query_normed = [(term_id, tf_idf/norm) for term_id, tf_idf in query_tfidfs]
-        return query_normed
+        # a single-term vector always normalizes to weight 1
+        if len(query) == 1:
+            return [(query[0], 1.0)]
+        weights = np.array([self.tfidf(term_id, 1) for term_id in query])
+        norm = np.sqrt(np.dot(weights, weights))
+        # a query of all-zero-idf terms has norm 0; leave its weights
+        # at 0 instead of dividing them into NaN
+        if norm > 0:
+            weights /= norm
+        return list(zip(query, weights.tolist()))
 
 
     # interfaces to communicate with inverted_index
@@ -388,6 +526,14 @@ class QueryProcessor():
         term_id :   id of term to get postings list for"""
         return self.inverted_index.get_postings_list(term_id)
 
+    def get_candidates(self, term_ids):
+        """Get ids of documents containing any of the terms.
+        Parameters
+        ----------
+        term_ids :  list of int
+                    ids of terms whose postings are to be merged"""
+        return self.inverted_index.get_candidates(term_ids)
+
     def get_document_name(self, doc_id):
         """Get name associated with document id.
         Parameters
@@ -396,14 +542,18 @@ class QueryProcessor():
                     id of document to get name for"""
         return self.inverted_index.get_document_name(doc_id)
 
-    def get_document(self, doc_id):
-        """Get term ids and tf-idf scores of terms in a document
+    def score_documents(self, query_weights, num_results, conjunctive):
+        """Score documents against a weighted query inside the database.
         Parameters
         ----------
-        doc_id :    int
-                    id of document to get doc ids and associated scores for
+        query_weights : iterable of tuples of int, float
+                        ids and normalized tf-idfs of terms in the query
+        num_results :   int
+                        Number of most similar results to return
+        conjunctive :   Boolean
+                        Require documents to contain all query terms
         """
-        return self.inverted_index.get_document(doc_id)
+        return self.inverted_index.score_documents(query_weights, num_results, conjunctive)
 
     def get_fulltext(self, doc_id):
         """Retrieve text of a document by its id.
@@ -423,9 +573,3 @@ class QueryProcessor():
         frequency : int
                     Frequency of term"""
         return self.inverted_index.tfidf(term_id, frequency)
-
-    def get_document_retriever(self):
-        """Return a function that retrieves documents by id, using its own
-        connection (for parallel access).
-        """
-        return self.inverted_index.get_document_retriever()
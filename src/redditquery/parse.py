@@ -4,8 +4,7 @@ import argparse
 
 
 def parser():
-    """Parses arguments from command line using argparse.
-    Parameters"""
+    """Parses arguments from command line using argparse."""
     # default directory for reddit files
     default_directory = os.path.join(os.getcwd(), "data")
 
@@ -1,20 +1,46 @@
 #!/usr/bin/python3
-import json
+import io
 import os
 import sys
 import spacy
+import requests
+import subprocess
+from shutil import which
 from pandas import period_range
-from multiprocessing import Pool
-from urllib.request import FancyURLopener
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from threading import Thread
+from queue import Queue
 from redditquery.utils import recursive_walk, check_directory
 
-urlretrieve = FancyURLopener().retrieve
+# orjson parses the multi-GB comment dumps several times faster
+# than the standard library; fall back silently if not installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 # data will be downloaded from http://files.pushshift.io/reddit/comments/
 # data structure is document in https://github.com/reddit/reddit/wiki/JSON
 
 
+def make_nlp(lemmatize):
+    """Build the lightest spacy pipeline that covers the work actually
+    done here: a blank tokenizer, plus a lookup lemmatizer when
+    lemmatization is requested. The full pipeline's tagger, parser and
+    NER are never used and cost more than everything else combined.
+    Parameters
+    ----------
+    lemmatize : Boolean
+                add a lookup lemmatizer to the tokenizer
+    """
+    nlp = spacy.blank("en")
+    if lemmatize:
+        nlp.add_pipe("lemmatizer", config = {"mode": "lookup"})
+        nlp.initialize()
+    return nlp
+
+
 class RedditDownloader():
     """ Downloads and Decompresses reddit comment archive files.
     Parameters
@@ -29,17 +55,23 @@ class RedditDownloader():
                         Display progress report to stderr
     keep_compressed :   Boolean
                         Keep compressed archive files
+    num_cores :         int, optional
+                        Number of cores to use for decompression
     """
 
-    def __init__(self, start, end, directory, report_progress, keep_compressed):
+    def __init__(self, start, end, directory, report_progress, keep_compressed, num_cores = 1):
         self.directory = check_directory(directory)
         self.report_progress = report_progress
         self.keep_compressed = keep_compressed
+        self.num_cores = num_cores
         self.months = period_range(start, end, freq = "M")
 
 
     def decompress(self, compressed_path, decompressed_path):
         """Decompress bz2 file (compressed_path) incrementally.
+        Decompresses blocks in parallel if more than one core is
+        available and a parallel bzip2 tool (lbzip2/pbzip2) or
+        indexed_bzip2 is installed.
         Parameters
         ----------
         compressed_path :   str or path object
@@ -47,6 +79,26 @@ class RedditDownloader():
         decompressed_path : str or path object
                             file to be decompressed into
         """
+        if self.num_cores > 1:
+            tool = which("lbzip2") or which("pbzip2")
+            if tool:
+                cores = ("-n{}" if tool.endswith("lbzip2") else "-p{}").format(self.num_cores)
+                with open(decompressed_path, 'wb') as decompressed:
+                    subprocess.run([tool, "-dc", cores, compressed_path], stdout = decompressed, check = True)
+                if not self.keep_compressed:
+                    os.remove(compressed_path)
+                return
+            try:
+                from indexed_bzip2 import IndexedBzip2File
+            except ImportError:
+                pass
+            else:
+                with open(decompressed_path, 'wb') as decompressed, IndexedBzip2File(compressed_path, parallelization = self.num_cores) as compressed:
+                    for data in iter(lambda : compressed.read(4 * 1024 * 1024), b''):
+                        decompressed.write(data)
+                if not self.keep_compressed:
+                    os.remove(compressed_path)
+                return
         from bz2 import BZ2Decompressor
         with open(decompressed_path, 'wb') as decompressed, open(compressed_path, 'rb') as compressed:
             decompressor = BZ2Decompressor()
@@ -64,15 +116,8 @@ class RedditDownloader():
         if not self.keep_compressed:
             os.remove(compressed_path)
 
-    @staticmethod
-    def download_progress(count, block_size, total_size):
-        """Hook to update download progress."""
-        percentage = min(int(100 * count * block_size / total_size),100)
-        sys.stderr.write("\rDownload: {}%".format(percentage))
-        sys.stderr.flush()
-
     def download_month(self, month):
-        """Download data for given month.
+        """Download data for given month, streaming in 1MB chunks.
         Parameters
         ----------
         month : str or date object
@@ -80,10 +125,18 @@ class RedditDownloader():
         """
         file_url = "http://files.pushshift.io/reddit/comments/RC_{}.bz2".format(month)
         file_path = os.path.join(self.directory, "RC_{}.bz2".format(month))
-        if self.report_progress:
-            urlretrieve(file_url, file_path, reporthook = RedditDownloader.download_progress)
-        else:
-            urlretrieve(file_url, file_path)
+        with requests.get(file_url, stream = True, timeout = 60) as response:
+            response.raise_for_status()
+            total_size = int(response.headers.get("Content-Length", 0))
+            size_so_far = 0
+            with open(file_path, 'wb') as downloaded:
+                for chunk in response.iter_content(chunk_size = 1024 * 1024):
+                    downloaded.write(chunk)
+                    if self.report_progress and total_size:
+                        size_so_far += len(chunk)
+                        percentage = min(int(size_so_far * 100 / total_size), 100)
+                        sys.stderr.write("\rDownload: {}%".format(percentage))
+                        sys.stderr.flush()
 
     def download_all(self):
         """Downloads data for all months in self.months"""
@@ -92,6 +145,15 @@ class RedditDownloader():
                 sys.stderr.write("\n")
             self.download_month(month)
 
+    def decompressed_path(self, month):
+        """Path of the decompressed file for given month.
+        Parameters
+        ----------
+        month : str or date object
+                Month to get path for, str(month) must result in YYYY/MM
+        """
+        return os.path.join(self.directory, "RC_{}.json".format(month))
+
     def decompress_month(self, month):
         """Decompress archive file for given month.
         Parameters
@@ -100,8 +162,7 @@ class RedditDownloader():
                 Month to be decompressed, str(month) must result in YYYY/MM
         """
         compressed_path = os.path.join(self.directory, "RC_{}.bz2".format(month))
-        decompressed_path = os.path.join(self.directory, "RC_{}.json".format(month))
-        self.decompress(compressed_path = compressed_path, decompressed_path = decompressed_path)
+        self.decompress(compressed_path = compressed_path, decompressed_path = self.decompressed_path(month))
 
     def decompress_all(self):
         """Decompress files for all months."""
@@ -119,12 +180,60 @@ class RedditDownloader():
         self.decompress_month(month)
 
     def process_all(self):
-        """Download and decompress files for all months."""
-        for month in self.months:
-            self.process_month(month)
+        """Download and decompress files for all months,
+        overlapping the download of each month with the decompression
+        of the previous one through a bounded queue. A failure on
+        either side stops the pipeline and is raised here."""
+        downloaded = Queue(maxsize = 2)
+        failure = list()
+        decompressor = Thread(target = self.decompress_queue, args = (downloaded, failure))
+        decompressor.start()
+        try:
+            for month in self.months:
+                if failure:
+                    break
+                if self.report_progress:
+                    sys.stderr.write("\n")
+                self.download_month(month)
+                downloaded.put(month)
+        finally:
+            # always deliver the sentinel, or a failed download would
+            # leave the consumer blocked on the queue forever
+            downloaded.put(None)
+            decompressor.join()
+        if failure:
+            raise failure[0]
+
+    def decompress_queue(self, downloaded, failure):
+        """Decompress months taken off a queue until receiving None.
+        An exception is recorded in failure and the queue is drained
+        without further work, so the producer never blocks against a
+        dead consumer.
+        Parameters
+        ----------
+        downloaded :    Queue
+                        Queue of months whose download has finished
+        failure :       list
+                        Container the first exception is appended to
+        """
+        while True:
+            month = downloaded.get()
+            if month is None:
+                break
+            if failure:
+                continue
+            try:
+                self.decompress_month(month)
+            except Exception as error:
+                failure.append(error)
 
     def process_all_parallel(self, num_cores):
-        """Download and decompress files for all months in parallel
+        """Download and decompress files for all months in parallel.
+        Downloads and decompressions run in separate executors, so
+        each month moves into decompression as soon as its download
+        finishes while the remaining downloads keep the socket busy;
+        downloads are socket-bound and bz2 releases the GIL, so
+        threads overlap both without fork or pickling overhead.
         Parameters
         ----------
         num_cores : int
@@ -132,41 +241,165 @@ class RedditDownloader():
         """
         if num_cores == 1:
             self.process_all()
+            return
+        self.report_progress = False
+        download_workers = max(1, num_cores // 2)
+        with ThreadPoolExecutor(max_workers = download_workers) as downloads, \
+             ThreadPoolExecutor(max_workers = max(1, num_cores - download_workers)) as decompressions:
+            downloading = {downloads.submit(self.download_month, month): month for month in self.months}
+            decompressing = list()
+            for finished in as_completed(downloading):
+                finished.result()
+                decompressing.append(decompressions.submit(self.decompress_month, downloading[finished]))
+            for finished in decompressing:
+                finished.result()
+
+    def stream_paths(self, num_cores = 1):
+        """Download and decompress all months in the background and
+        yield each decompressed path as soon as it is ready, so
+        indexing can start while later months are still downloading.
+        Parameters
+        ----------
+        num_cores : int, optional
+                    Number of cores to use
+        """
+        ready = Queue(maxsize = max(1, num_cores))
+        # daemonized so that a consumer abandoning the generator (an
+        # exception during indexing) cannot hang interpreter exit on
+        # a producer blocked against the bounded queue
+        producer = Thread(target = self.produce_paths, args = (ready, num_cores), daemon = True)
+        producer.start()
+        while True:
+            path = ready.get()
+            if path is None:
+                break
+            if isinstance(path, Exception):
+                producer.join()
+                raise path
+            yield path
+        producer.join()
+
+    def produce_paths(self, ready, num_cores):
+        """Run the download/decompression pipeline, posting each
+        decompressed path to the queue and None once all are done; a
+        failure is posted as the exception itself, so the consumer
+        raises instead of treating it as a normal end of the stream.
+        Parameters
+        ----------
+        ready :     Queue
+                    Queue to post decompressed paths to
+        num_cores : int
+                    Number of cores to use
+        """
+        try:
+            if num_cores == 1:
+                for month in self.months:
+                    if self.report_progress:
+                        sys.stderr.write("\n")
+                    self.process_month(month)
+                    ready.put(self.decompressed_path(month))
+            else:
+                self.report_progress = False
+                download_workers = max(1, num_cores // 2)
+                with ThreadPoolExecutor(max_workers = download_workers) as downloads, \
+                     ThreadPoolExecutor(max_workers = max(1, num_cores - download_workers)) as decompressions:
+                    downloading = {downloads.submit(self.download_month, month): month for month in self.months}
+                    decompressing = dict()
+                    # downloads and decompressions share one pending
+                    # pool, so each month is decompressed and yielded
+                    # as soon as it is ready rather than after the
+                    # last download has finished
+                    pending = set(downloading)
+                    while pending:
+                        done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                        for finished in done:
+                            finished.result()
+                            if finished in downloading:
+                                month = downloading[finished]
+                                decompression = decompressions.submit(self.decompress_month, month)
+                                decompressing[decompression] = month
+                                pending.add(decompression)
+                            else:
+                                ready.put(self.decompressed_path(decompressing[finished]))
+        except Exception as error:
+            ready.put(error)
         else:
-            self.report_progress = False
-            with Pool(num_cores) as pool:
-                for _ in pool.imap_unordered(self.process_month, self.months):
-                    pass
+            ready.put(None)
+
+
+def iter_comments(file_path, buffering = 4 * 1024 * 1024):
+    """Generator for the comments in a reddit archive file,
+    decompressing on the fly with a large buffer if still compressed.
+    Parameters
+    ----------
+    file_path : str or path object
+                Archive file (json or bz2) with one comment per line
+    buffering : int, optional
+                Size of the read buffer in bytes
+    """
+    if file_path.endswith("bz2"):
+        from bz2 import BZ2File
+        comments = io.TextIOWrapper(io.BufferedReader(BZ2File(file_path), buffer_size = buffering), encoding = "utf-8")
+    else:
+        comments = open(file_path, "r", buffering = buffering)
+    with comments:
+        for comment in comments:
+            yield json_loads(comment)
 
 
-def DocumentGenerator(directory, fulltext, lemmatize):
+def DocumentGenerator(directory, fulltext, lemmatize, num_cores = 1, paths = None, remove_after = False):
     """
-    Takes a directory with reddit comment archive files (JSON)
-    and returns tuples of the comment id and a list of tokens for each comment.
+    Takes a directory with reddit comment archive files (JSON, optionally
+    bz2-compressed) and returns tuples of the comment id and a list of
+    tokens for each comment.
     Parameters
     ----------
-    directory : str or path object
-                Directory with comment files
-    fulltext :  Boolean
-                return full comment as well
-    lemmatize : Boolean
-                lemmatize tokens in comments
+    directory :     str or path object
+                    Directory with comment files
+    fulltext :      Boolean
+                    return full comment as well
+    lemmatize :     Boolean
+                    lemmatize tokens in comments
+    num_cores :     int, optional
+                    number of processes for the nlp pipeline
+    paths :         iterable of str, optional
+                    File paths to process instead of walking the
+                    directory, consumed as they become available
+    remove_after :  Boolean, optional
+                    Remove each file once it has been fully read
     """
-    files = recursive_walk(directory)
-    nlp = spacy.load("en")
-    for month in files:
-        if not month.endswith("json"):
-            continue
-        month = open(month, "r")
-        for comment in month:
-            comment = json.loads(comment)
-            text = comment["body"]
-            comment_id = comment["id"]
-            tokens = nlp(text)
-            if lemmatize:
-                tokens = [token.lemma_.strip().lower() for token in tokens if not token.pos_.startswith(u"PU")] # filter punctuation
-            else:
-                tokens = [token.string.strip().lower() for token in tokens if not token.pos_.startswith(u"PU")]
-            if not fulltext:
-                text = ""
-            yield comment_id, tokens, text
\ No newline at end of file
+    nlp = make_nlp(lemmatize)
+
+    def comment_stream():
+        for month in (paths if paths is not None else recursive_walk(directory)):
+            if not month.endswith("json") and not month.endswith("bz2"):
+                continue
+            for comment in iter_comments(month):
+                text = comment["body"]
+                yield text, (comment["id"], text if fulltext else "")
+            if remove_after:
+                os.remove(month)
+
+    piped = nlp.pipe(comment_stream(), as_tuples = True, batch_size = 1000, n_process = num_cores)
+    if not lemmatize:
+        for document, (comment_id, text) in piped:
+            yield comment_id, [token.lower_ for token in document if not token.is_punct], text
+        return
+    # lemmatization is deterministic per surface form and comments
+    # reuse tokens heavily, so memoize text -> lowercased lemma
+    lemma_cache = dict()
+    cache_limit = 262144
+    for document, (comment_id, text) in piped:
+        tokens = list()
+        append = tokens.append
+        for token in document:
+            if token.is_punct:
+                continue
+            surface = token.text
+            lemma = lemma_cache.get(surface)
+            if lemma is None:
+                lemma = token.lemma_.lower()
+                if len(lemma_cache) < cache_limit:
+                    lemma_cache[surface] = lemma
+            append(lemma)
+        yield comment_id, tokens, text
\ No newline at end of file
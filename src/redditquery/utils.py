@@ -17,30 +17,46 @@ class Numberer:
 
     def __init__(self, start = 0):
         self.known = dict()
+        self.by_value = dict()
         self.num_keys = start
 
     def get(self, key):
-        """get/set number for term
+        """get/set number for term; numbers are assigned densely
+        starting from start, so they stay small; a sentinel keeps
+        this to one dict lookup per call with no exception overhead
+        for unseen keys
         Parameters
         ----------
         key :   str
                 key to get number for"""
-        try:
-            return self.known[key]
-        except KeyError:
-            self.num_keys += 1
-            self.known[key] = self.num_keys
-            return self.num_keys
+        number = self.known.get(key, -1)
+        if number >= 0:
+            return number
+        number = self.num_keys
+        self.known[key] = number
+        self.by_value[number] = key
+        self.num_keys = number + 1
+        return number
+
+    def lookup(self, key):
+        """get number for key without assigning one to unseen keys,
+        returns -1 if the key is unknown
+        Parameters
+        ----------
+        key :   str
+                key to look up"""
+        return self.known.get(key, -1)
 
     def remove_values(self, values):
-        """Remove known terms by value
+        """Remove known terms by value; the reverse index makes this
+        proportional to the removals rather than the vocabulary
         Parameters
         ----------
         values :    iterable of int
                     values to be removed"""
-        values = set(values)
-        for key in list(self.known.keys()):
-            if self.known[key] in values:
+        for value in values:
+            key = self.by_value.pop(value, None)
+            if key is not None:
                 del self.known[key]
 
 def recursive_walk(directory):
@@ -50,12 +66,9 @@ def recursive_walk(directory):
     directory : string or path object
                 Directory to be traversed
     """
-    for folderName, subFolders, fileNames in os.walk(directory):
-        if subFolders:
-            for subFolder in subFolders:
-                recursive_walk(os.path.join(folderName, subFolder))
-        for fileName in fileNames:
-            yield os.path.join(folderName, fileName)
+    for folder_name, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            yield os.path.join(folder_name, file_name)
 
 def check_directory(directory):
     """Create directory if it's not a file. Issues warning if not empty.